@@ -7,26 +7,89 @@ import errno
 from logging import getLogger
 from loris_exception import ResolverException
 from os.path import join, exists, dirname
-from os import makedirs, rename, remove
-from shutil import copy
+from os import makedirs, link, remove, rename, sep, stat
+from shutil import copy, copyfileobj
 import tempfile
 from urllib import unquote, quote_plus
 from contextlib import closing
+from cookielib import DefaultCookiePolicy
+from threading import Lock
+from time import time
 
 import constants
 import hashlib
 import glob
 import requests
+from requests.adapters import HTTPAdapter
 import re
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
 logger = getLogger(__name__)
 
 
+class _LRUCache(object):
+    '''
+    A small, thread-safe map that holds at most `size` entries, evicting the
+    least recently used one when full. Only the methods the resolvers need
+    are implemented: `get`, put (`instance[key] = value`), `del` and `len`.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self._dict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._dict.pop(key)
+            except KeyError:
+                return default
+            # re-insert so the entry becomes the most recently used
+            self._dict[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._dict.pop(key, None)
+            while len(self._dict) >= self.size:
+                self._dict.popitem(last=False)
+            self._dict[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._dict.pop(key, None)
+
+    def __len__(self):
+        return len(self._dict)
+
+
+# copying an empty hasher is cheaper than setting up a new one each time
+_MD5_PROTOTYPE = hashlib.md5()
+
+# (ident, hash version) -> hashed cache subdirectory, shared by all SimpleHTTPResolvers
+_cache_subroots = _LRUCache(4096)
+
+
 class _AbstractResolver(object):
 
+    # resolve() results are only remembered in memory when a resolver opts in,
+    # either here or through the `resolve_cache_size` setting
+    default_resolve_cache_size = 0
+
     def __init__(self, config):
         self.config = config
 
+        # ident -> (fp, format, mtime, expires_at) for recent resolve() results;
+        # see _get_resolved() and _set_resolved()
+        settings = config or {}
+        resolve_cache_size = int(settings.get('resolve_cache_size', self.default_resolve_cache_size))
+        self.resolve_cache_ttl = float(settings.get('resolve_cache_ttl', 0))
+        self._resolved = _LRUCache(resolve_cache_size) if resolve_cache_size > 0 else None
+
     def is_resolvable(self, ident):
         """
         The idea here is that in some scenarios it may be cheaper to check
@@ -59,9 +122,43 @@ class _AbstractResolver(object):
         cn = self.__class__.__name__
         raise NotImplementedError('resolve() not implemented for %s' % (cn,))
 
+    def _get_resolved(self, ident):
+        '''
+        The (fp, format) remembered for `ident` by `_set_resolved()`, or None
+        if there is none, it is older than `resolve_cache_ttl` seconds, or the
+        file has been changed or removed since. Costs one stat on a hit.
+        '''
+        if self._resolved is None:
+            return None
+        entry = self._resolved.get(ident)
+        if entry is None:
+            return None
+        fp, format_, mtime, expires_at = entry
+        try:
+            if (expires_at is None or expires_at > time()) and stat(fp).st_mtime == mtime:
+                return (fp, format_)
+        except OSError:
+            pass
+        del self._resolved[ident]
+        return None
+
+    def _set_resolved(self, ident, fp, format_):
+        '''
+        Remember the result of resolving `ident` and return it as (fp, format).
+        '''
+        if self._resolved is not None:
+            try:
+                mtime = stat(fp).st_mtime
+            except OSError:
+                return (fp, format_)
+            expires_at = time() + self.resolve_cache_ttl if self.resolve_cache_ttl > 0 else None
+            self._resolved[ident] = (fp, format_, mtime, expires_at)
+        return (fp, format_)
+
     def format_from_ident(self, ident):
-        if ident.rfind('.') != -1:
-            extension = ident.split('.')[-1]
+        i = ident.rfind('.')
+        if i != -1:
+            extension = ident[i+1:]
             if len(extension) < 5:
                 extension = extension.lower()
                 return constants.EXTENSION_MAP.get(extension, extension)
@@ -99,16 +196,19 @@ class SimpleFSResolver(_AbstractResolver):
         return not self.source_file_path(ident) is None
 
     def resolve(self, ident):
+        resolved = self._get_resolved(ident)
+        if resolved is not None:
+            return resolved
 
-        if not self.is_resolvable(ident):
+        source_fp = self.source_file_path(ident)
+        if source_fp is None:
             self.raise_404_for_ident(ident)
 
-        source_fp = self.source_file_path(ident)
-        logger.debug('src image: %s' % (source_fp,))
+        logger.debug('src image: %s', source_fp)
 
         format_ = self.format_from_ident(ident)
 
-        return (source_fp, format_)
+        return self._set_resolved(ident, source_fp, format_)
 
 
 class ExtensionNormalizingFSResolver(SimpleFSResolver):
@@ -145,7 +245,23 @@ class SimpleHTTPResolver(_AbstractResolver):
      self-signed certificate.
      * `cert`, path to an SSL client certificate to use for authentication. If `cert` and `key` are both present, they take precedence over `user` and `pw` for authetication.
      * `key`, path to an SSL client key to use for authentication.
+     * `head_cache_ttl`, how many seconds (default 5) to remember the outcome
+        of the HEAD or GET `is_resolvable()` makes to the source server, so a
+        check followed by `resolve()` or by further checks within that window
+        doesn't probe the server again. Set to 0 to disable.
+     * `cache_hash_version`, how identifiers are hashed into cache directories.
+        1 (the default) hashes the url-quoted identifier; 2 hashes the raw
+        UTF-8 bytes. The two layouts differ, so images cached under 1 are
+        fetched again after switching to 2.
+     * `resolve_cache_size`, how many `resolve()` results to remember in
+        memory (default 8192, 0 disables). A result is reused while the cached
+        file is unchanged, or for at most `resolve_cache_ttl` seconds if that
+        is set.
     '''
+    # the source is never consulted again once an image is in the local
+    # cache, so remembering resolve() results doesn't make them any staler
+    default_resolve_cache_size = 8192
+
     def __init__(self, config):
         super(SimpleHTTPResolver, self).__init__(config)
 
@@ -169,7 +285,12 @@ class SimpleHTTPResolver(_AbstractResolver):
 
         self.ssl_check = self.config.get('ssl_check', True)
 
-        self.ident_regex = self.config.get('ident_regex', False)
+        self.head_cache_ttl = float(self.config.get('head_cache_ttl', 5))
+
+        self.cache_hash_version = int(self.config.get('cache_hash_version', 1))
+
+        ident_regex = self.config.get('ident_regex', None)
+        self._ident_regex = re.compile(ident_regex) if ident_regex else None
 
         if 'cache_root' in self.config:
             self.cache_root = self.config['cache_root']
@@ -184,41 +305,76 @@ class SimpleHTTPResolver(_AbstractResolver):
             logger.error(message)
             raise ResolverException(500, message)
 
-    def request_options(self):
-        # parameters to pass to all head and get requests;
-        options = {}
+        if self.cache_hash_version not in (1, 2):
+            message = 'Server Side Error: Configuration error. cache_hash_version must be 1 or 2.'
+            logger.error(message)
+            raise ResolverException(500, message)
+
+        # parameters to pass to all head and get requests; built once as the
+        # config does not change after startup
+        self._base_request_options = {}
         if self.cert is not None and self.key is not None:
-            options['cert'] = (self.cert, self.key)
+            self._base_request_options['cert'] = (self.cert, self.key)
         if self.user is not None and self.pw is not None:
-            options['auth'] = (self.user, self.pw)
-        options['verify'] = self.ssl_check
-        return options
+            self._base_request_options['auth'] = (self.user, self.pw)
+        self._base_request_options['verify'] = self.ssl_check
+
+        # one session per resolver so that keep-alive connections to the
+        # source server(s) are pooled and reused across identifiers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.cert = self._base_request_options.get('cert')
+        self.session.auth = self._base_request_options.get('auth')
+        self.session.verify = self.ssl_check
+        # don't keep cookies: requests should stay independent of each other,
+        # and templates with different credentials may share a host
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        # ident -> (expires_at, bool) for recent source server probes
+        self._head_ttl_cache = _LRUCache(1024)
+
+    def request_options(self):
+        # these match the session defaults; return a copy since subclasses
+        # may layer per-request overrides onto it
+        return dict(self._base_request_options)
 
     def is_resolvable(self, ident):
+        """
+        True if the image is already in the local cache or the source server
+        answers the HEAD (or GET, unless `head_resolvable`) request for it.
+        Answers from the source server are remembered for `head_cache_ttl`
+        seconds; `resolve()` does not call this method, so callers that check
+        first and then resolve pay for at most one probe plus the download.
+        """
         ident = unquote(ident)
 
-        if self.ident_regex:
-            regex = re.compile(self.ident_regex)
-            if not regex.match(ident):
-                return False
+        if self._ident_regex and not self._ident_regex.match(ident):
+            return False
 
-        fp = join(self.cache_root, SimpleHTTPResolver._cache_subroot(ident))
+        fp = join(self.cache_root, SimpleHTTPResolver._cache_subroot(ident, self.cache_hash_version))
         if exists(fp):
             return True
-        else:
-            (url, options) = self._web_request_url(ident)
 
-            if self.head_resolvable:
-                response = requests.head(url, **options)
-                if response.ok:
-                    return True
+        cached = self._head_ttl_cache.get(ident)
+        if cached is not None and cached[0] > time():
+            return cached[1]
 
-            else:
-                with closing(requests.get(url, stream=True, **options)) as response:
-                    if response.ok:
-                        return True
+        resolvable = self._is_resolvable_at_source(ident)
+        if self.head_cache_ttl > 0:
+            self._head_ttl_cache[ident] = (time() + self.head_cache_ttl, resolvable)
+        return resolvable
 
-        return False
+    def _is_resolvable_at_source(self, ident):
+        (url, options) = self._web_request_url(ident)
+
+        if self.head_resolvable:
+            response = self.session.head(url, **options)
+            return response.ok
+        else:
+            with closing(self.session.get(url, stream=True, **options)) as response:
+                return response.ok
 
     def get_format(self, ident, potential_format):
         if self.default_format is not None:
@@ -229,13 +385,12 @@ class SimpleHTTPResolver(_AbstractResolver):
             return self.format_from_ident(ident)
 
     def _web_request_url(self, ident):
-        if (ident.startswith('http://') or ident.startswith('https://')) and self.uri_resolvable:
-            url = ident
-        else:
-            url = self.source_prefix + ident + self.source_suffix
-        if not (url.startswith('http://') or url.startswith('https://')):
+        if self.uri_resolvable and ident.startswith(('http://', 'https://')):
+            return (ident, self.request_options())
+        url = self.source_prefix + ident + self.source_suffix
+        if not url.startswith(('http://', 'https://')):
             logger.warn(
-                'Bad URL request at %s for identifier: %s.' % (source_url, ident)
+                'Bad URL request at %s for identifier: %s.' % (url, ident)
             )
             public_message = 'Bad URL request made for identifier: %s.' % (ident,)
             raise ResolverException(404, public_message)
@@ -243,38 +398,51 @@ class SimpleHTTPResolver(_AbstractResolver):
 
     # Get a subdirectory structure for the cache_subroot through hashing.
     @staticmethod
-    def _cache_subroot(ident):
-        cache_subroot = ''
-
-        # Split out potential pidspaces... Fedora Commons most likely use case.
-        if ident[0:6] != 'http:/' and ident[0:7] != 'https:/' and len(ident.split(':')) > 1:
-            for split_ident in ident.split(':')[0:-1]:
-                cache_subroot = join(cache_subroot, split_ident)
-        elif ident[0:6] == 'http:/' or ident[0:7] == 'https:/':
+    def _cache_subroot(ident, hash_version=1):
+        cache_subroot = _cache_subroots.get((ident, hash_version))
+        if cache_subroot is not None:
+            return cache_subroot
+
+        # A single slash is enough to spot a uri: the // is sometimes
+        # collapsed on its way through the request path.
+        if ident.startswith(('http:/', 'https:/')):
             cache_subroot = 'http'
+        # Split out potential pidspaces... Fedora Commons most likely use case.
+        elif ':' in ident:
+            cache_subroot = join(*ident.split(':')[0:-1])
+        else:
+            cache_subroot = ''
 
-        cache_subroot = join(cache_subroot, SimpleHTTPResolver._ident_file_structure(ident))
+        cache_subroot = join(cache_subroot, SimpleHTTPResolver._ident_file_structure(ident, hash_version))
 
+        _cache_subroots[(ident, hash_version)] = cache_subroot
         return cache_subroot
 
     # Get the directory structure of the identifier itself
     @staticmethod
-    def _ident_file_structure(ident):
-        file_structure = ''
-        ident_hash = hashlib.md5(quote_plus(ident)).hexdigest()
-        # First level 2 digit directory then do three digits...
-        file_structure_list = [ident_hash[0:2]] + [ident_hash[i:i+3] for i in range(2, len(ident_hash), 3)]
-
-        for piece in file_structure_list:
-            file_structure = join(file_structure, piece)
-
-        return file_structure
+    def _ident_file_structure(ident, hash_version=1):
+        md5 = _MD5_PROTOTYPE.copy()
+        if hash_version == 2:
+            # MD5 only needs stable bytes; quoting them first is wasted work
+            if isinstance(ident, unicode):
+                ident = ident.encode('utf-8')
+            md5.update(ident)
+        else:
+            md5.update(quote_plus(ident))
+        ident_hash = md5.hexdigest()
+        # First level 2 digit directory then do three digits... an MD5 hex
+        # digest is always 32 characters, so the offsets are fixed.
+        h = ident_hash
+        return sep.join((
+            h[0:2], h[2:5], h[5:8], h[8:11], h[11:14], h[14:17],
+            h[17:20], h[20:23], h[23:26], h[26:29], h[29:32]
+        ))
 
     def cache_dir_path(self, ident):
         ident = unquote(ident)
         return join(
                 self.cache_root,
-                SimpleHTTPResolver._cache_subroot(ident)
+                SimpleHTTPResolver._cache_subroot(ident, self.cache_hash_version)
         )
 
     def raise_404_for_ident(self, ident):
@@ -283,16 +451,33 @@ class SimpleHTTPResolver(_AbstractResolver):
 
     def cached_file_for_ident(self, ident):
         cache_dir = self.cache_dir_path(ident)
-        if exists(cache_dir):
-            files = glob.glob(join(cache_dir, 'loris_cache.*'))
-            if files:
-                return files[0]
+
+        # copy_to_cache() names the file after default_format when it is set,
+        # and usually after the identifier's extension otherwise (unless the
+        # content-type says differently), so look for that file before
+        # falling back to listing the directory.
+        if self.default_format is not None:
+            fp = join(cache_dir, 'loris_cache.' + self.default_format)
+            return fp if exists(fp) else None
+        try:
+            fp = join(cache_dir, 'loris_cache.' + self.format_from_ident(unquote(ident)))
+            if exists(fp):
+                return fp
+        except ResolverException:
+            pass
+
+        # glob() copes with a missing directory itself, so don't stat it first
+        files = glob.glob(join(cache_dir, 'loris_cache.*'))
+        if files:
+            return files[0]
         return None
 
     def cache_file_extension(self, ident, response):
         if 'content-type' in response.headers:
+            # ignore case and any parameters, e.g. 'image/jpeg; charset=binary'
+            media_type = response.headers['content-type'].split(';', 1)[0].strip().lower()
             try:
-                extension = self.get_format(ident, constants.FORMATS_BY_MEDIA_TYPE[response.headers['content-type']])
+                extension = self.get_format(ident, constants.FORMATS_BY_MEDIA_TYPE[media_type])
             except KeyError:
                 logger.warn('Your server may be responding with incorrect content-types. Reported %s for ident %s.'
                             % (response.headers['content-type'], ident))
@@ -303,6 +488,10 @@ class SimpleHTTPResolver(_AbstractResolver):
         return extension
 
     def _create_cache_dir(self, cache_dir):
+        # usually the directory is already there from an earlier request, and
+        # a stat is much cheaper than raising and catching EEXIST
+        if exists(cache_dir):
+            return
         try:
             makedirs(cache_dir)
         except OSError as ose:
@@ -318,7 +507,7 @@ class SimpleHTTPResolver(_AbstractResolver):
 
         #get source image and write to temporary file
         (source_url, options) = self._web_request_url(ident)
-        with closing(requests.get(source_url, stream=True, **options)) as response:
+        with closing(self.session.get(source_url, stream=True, **options)) as response:
             if not response.ok:
                 public_message = 'Source image not found for identifier: %s. Status code returned: %s' % (ident,response.status_code)
                 log_message = 'Source image not found at %s for identifier: %s. Status code returned: %s' % (source_url,ident,response.status_code)
@@ -329,27 +518,45 @@ class SimpleHTTPResolver(_AbstractResolver):
             local_fp = join(cache_dir, "loris_cache." + extension)
 
             with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as tmp_file:
-                for chunk in response.iter_content(2048):
-                    tmp_file.write(chunk)
+                # read straight from the raw response, still undoing any
+                # content-encoding as iter_content() would
+                response.raw.decode_content = True
+                copyfileobj(response.raw, tmp_file, 1 << 20)
                 tmp_file.flush()
 
-            #now rename the tmp file to the desired file name if it still doesn't exist
-            #   (another process could have created it)
-            if exists(local_fp):
-                logger.info('another process downloaded src image %s' % local_fp)
-                remove(tmp_file.name)
+            #now link the tmp file to the desired file name if it still doesn't exist
+            #   (another process could have created it); unlike checking and
+            #   then renaming, link() fails atomically if the name is taken
+            try:
+                link(tmp_file.name, local_fp)
+            except OSError as ose:
+                if ose.errno == errno.EEXIST:
+                    logger.info('another process downloaded src image %s', local_fp)
+                else:
+                    # some filesystems (e.g. CIFS without unix extensions,
+                    # some FUSE mounts) don't support hard links; rename instead
+                    rename(tmp_file.name, local_fp)
+                    logger.info("Copied %s to %s", source_url, local_fp)
             else:
-                rename(tmp_file.name, local_fp)
-                logger.info("Copied %s to %s" % (source_url, local_fp))
+                logger.info("Copied %s to %s", source_url, local_fp)
+            finally:
+                try:
+                    remove(tmp_file.name)
+                except OSError:
+                    pass
 
         return local_fp
 
     def resolve(self, ident):
+        resolved = self._get_resolved(ident)
+        if resolved is not None:
+            return resolved
+
         cached_file_path = self.cached_file_for_ident(ident)
         if not cached_file_path:
             cached_file_path = self.copy_to_cache(ident)
         format_ = self.get_format(cached_file_path, None)
-        return (cached_file_path, format_)
+        return self._set_resolved(ident, cached_file_path, format_)
 
 
 class TemplateHTTPResolver(SimpleHTTPResolver):
@@ -395,6 +602,9 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
         if not templates:
             logger.warn('No templates specified in configuration')
         self.templates = {}
+        # request options for each template: the generic ones with any
+        # template-specific overrides applied
+        self._template_options = {}
         for name in templates.split(','):
             name = name.strip()
             cfg = self.config.get(name, None)
@@ -402,7 +612,18 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
                 logger.warn('No configuration specified for resolver template %s' % name)
             else:
                 self.templates[name] = cfg
-        logger.debug('TemplateHTTPResolver templates: %s' % str(self.templates))
+                self._template_options[name] = self._options_for_template(cfg)
+        logger.debug('TemplateHTTPResolver templates: %s', self.templates)
+
+    def _options_for_template(self, conf):
+        options = self.request_options()
+        if 'cert' in conf and 'key' in conf:
+            options['cert'] = (conf['cert'], conf['key'])
+        if 'user' in conf and 'pw' in conf:
+            options['auth'] = (conf['user'], conf['pw'])
+        if 'ssl_check' in conf:
+            options['verify'] = conf['ssl_check']
+        return options
 
     def _web_request_url(self, ident):
         # only split identifiers that look like template ids;
@@ -426,17 +647,7 @@ class TemplateHTTPResolver(SimpleHTTPResolver):
             # and loris will return a 404
             return (None, {})
         else:
-            # first get the generic options
-            options = self.request_options()
-            # then add any template-specific ones
-            conf = self.templates[prefix]
-            if 'cert' in conf and 'key' in conf:
-                options['cert'] = (conf['cert'], conf['key'])
-            if 'user' in conf and 'pw' in conf:
-                options['auth'] = (conf['user'], conf['pw'])
-            if 'ssl_check' in conf:
-                options['verify'] = conf['ssl_check']
-            return (url, options)
+            return (url, self._template_options[prefix])
 
 
 class SourceImageCachingResolver(_AbstractResolver):
@@ -474,9 +685,16 @@ class SourceImageCachingResolver(_AbstractResolver):
         source_fp = self.source_file_path(ident)
         cache_fp = self.cache_file_path(ident)
 
-        makedirs(dirname(cache_fp))
+        cache_dp = dirname(cache_fp)
+        if not exists(cache_dp):
+            try:
+                makedirs(cache_dp)
+            except OSError as ose:
+                if ose.errno != errno.EEXIST:
+                    raise
+
         copy(source_fp, cache_fp)
-        logger.info("Copied %s to %s" % (source_fp, cache_fp))
+        logger.info("Copied %s to %s", source_fp, cache_fp)
 
     def raise_404_for_ident(self, ident):
         source_fp = self.source_file_path(ident)
@@ -486,13 +704,19 @@ class SourceImageCachingResolver(_AbstractResolver):
         raise ResolverException(404, public_message)
 
     def resolve(self, ident):
-        if not self.is_resolvable(ident):
+        resolved = self._get_resolved(ident)
+        if resolved is not None:
+            return resolved
+
+        source_fp = self.source_file_path(ident)
+        if not exists(source_fp):
             self.raise_404_for_ident(ident)
-        if not self.in_cache(ident):
-            self.copy_to_cache(ident)
 
         cache_fp = self.cache_file_path(ident)
-        logger.debug('Image Served from local cache: %s' % (cache_fp,))
+        if not exists(cache_fp):
+            self.copy_to_cache(ident)
+
+        logger.debug('Image Served from local cache: %s', cache_fp)
 
         format_ = self.format_from_ident(ident)
-        return (cache_fp, format_)
+        return self._set_resolved(ident, cache_fp, format_)
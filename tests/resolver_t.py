@@ -2,6 +2,7 @@
 from loris.loris_exception import ResolverException
 from loris.resolver import (
         _AbstractResolver,
+        _LRUCache,
         SimpleHTTPResolver,
         TemplateHTTPResolver,
         SourceImageCachingResolver,
@@ -41,6 +42,28 @@ class Test_AbstractResolver(unittest.TestCase):
             _AbstractResolver(None).format_from_ident('datastream/content.master')
 
 
+class Test_LRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = _LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        # touching 'a' makes 'b' the eviction candidate
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_delete(self):
+        cache = _LRUCache(2)
+        cache['a'] = 1
+        del cache['a']
+        del cache['missing']
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+
 class Test_SimpleFSResolver(loris_t.LorisTest):
 
     def test_configured_resolver(self):
@@ -89,15 +112,18 @@ class Test_SimpleHTTPResolver(loris_t.LorisTest):
         responses.add(responses.GET, 'http://sample.sample/0001',
                       body='II*\x00\x0c\x00\x00\x00\x80\x00  \x0e\x00\x00\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x01\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x02\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x03\x01\x03\x00\x01\x00\x00\x00\x05\x00\x00\x00\x06\x01\x03\x00\x01\x00\x00\x00\x03\x00\x00\x00\x11\x01\x04\x00\x01\x00\x00\x00\x08\x00\x00\x00\x15\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x16\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x17\x01\x04\x00\x01\x00\x00\x00\x04\x00\x00\x00\x1a\x01\x05\x00\x01\x00\x00\x00\xba\x00\x00\x00\x1b\x01\x05\x00\x01\x00\x00\x00\xc2\x00\x00\x00\x1c\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00(\x01\x03\x00\x01\x00\x00\x00\x02\x00\x00\x00@\x01\x03\x00\x00\x03\x00\x00\xca\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00\xff`\xe6q\x19\x08\x00\x00\x80\t\x00\x00\x80\n\x00\x00\x80\x0b\x00\x00\x80\x0c\x00\x00\x80\r',
                       status=200,
+                      stream=True,
                       content_type='image/tiff')
 
         responses.add(responses.GET, 'http://sample.sample/0002',
                       body='II*\x00\x0c\x00\x00\x00\x80\x00  \x0e\x00\x00\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x01\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x02\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x03\x01\x03\x00\x01\x00\x00\x00\x05\x00\x00\x00\x06\x01\x03\x00\x01\x00\x00\x00\x03\x00\x00\x00\x11\x01\x04\x00\x01\x00\x00\x00\x08\x00\x00\x00\x15\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x16\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x17\x01\x04\x00\x01\x00\x00\x00\x04\x00\x00\x00\x1a\x01\x05\x00\x01\x00\x00\x00\xba\x00\x00\x00\x1b\x01\x05\x00\x01\x00\x00\x00\xc2\x00\x00\x00\x1c\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00(\x01\x03\x00\x01\x00\x00\x00\x02\x00\x00\x00@\x01\x03\x00\x00\x03\x00\x00\xca\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00\xff`\xe6q\x19\x08\x00\x00\x80\t\x00\x00\x80\n\x00\x00\x80\x0b\x00\x00\x80\x0c\x00\x00\x80\r',
-                      status=200)
+                      status=200,
+                      stream=True)
 
         responses.add(responses.GET, 'http://sample.sample/0003',
                       body='II*\x00\x0c\x00\x00\x00\x80\x00  \x0e\x00\x00\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x01\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x02\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x03\x01\x03\x00\x01\x00\x00\x00\x05\x00\x00\x00\x06\x01\x03\x00\x01\x00\x00\x00\x03\x00\x00\x00\x11\x01\x04\x00\x01\x00\x00\x00\x08\x00\x00\x00\x15\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x16\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x17\x01\x04\x00\x01\x00\x00\x00\x04\x00\x00\x00\x1a\x01\x05\x00\x01\x00\x00\x00\xba\x00\x00\x00\x1b\x01\x05\x00\x01\x00\x00\x00\xc2\x00\x00\x00\x1c\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00(\x01\x03\x00\x01\x00\x00\x00\x02\x00\x00\x00@\x01\x03\x00\x00\x03\x00\x00\xca\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00\xff`\xe6q\x19\x08\x00\x00\x80\t\x00\x00\x80\n\x00\x00\x80\x0b\x00\x00\x80\x0c\x00\x00\x80\r',
                       status=200,
+                      stream=True,
                       content_type='image/invalidformat')
 
         responses.add(responses.GET, 'http://sample.sample/DOESNOTEXIST',
@@ -272,7 +298,10 @@ class Test_TemplateHTTPResolver(loris_t.LorisTest):
                 'url': 'http://mysite.com/images/%s/access/'
             },
             'c': {
-                'url': 'http://othersite.co/img/%s'
+                'url': 'http://othersite.co/img/%s',
+                'user': 'otheruser',
+                'pw': 'secret',
+                'ssl_check': False
             }
         }
 
@@ -301,11 +330,18 @@ class Test_TemplateHTTPResolver(loris_t.LorisTest):
         self.assertEqual(None,
             self.app.resolver._web_request_url('unknown:id2')[0])
 
+        # test per-template request options
+        self.assertEqual({'verify': True},
+            self.app.resolver._web_request_url('a:foo.jpg')[1])
+        self.assertEqual({'auth': ('otheruser', 'secret'), 'verify': False},
+            self.app.resolver._web_request_url('c:foo')[1])
+
 
 def suite():
     import unittest
     test_suites = []
     test_suites.append(unittest.makeSuite(Test_AbstractResolver, 'test'))
+    test_suites.append(unittest.makeSuite(Test_LRUCache, 'test'))
     test_suites.append(unittest.makeSuite(Test_SimpleFSResolver, 'test'))
     test_suites.append(unittest.makeSuite(Test_SourceImageCachingResolver, 'test'))
     test_suites.append(unittest.makeSuite(Test_SimpleHTTPResolver, 'test'))
@@ -1,4 +1,5 @@
 from .abstract_resolver import AbstractResolverTest
+from loris import loris_exception
 from loris import resolver
 import os
 import unittest
@@ -25,6 +26,20 @@ class SimpleFSResolverTest(AbstractResolverTest, unittest.TestCase):
 
         self.resolver = resolver.SimpleFSResolver(single_config)
 
+    def test_resolve_is_remembered(self):
+        config = dict(self.resolver.config, resolve_cache_size=10)
+        self.resolver = self.resolver.__class__(config)
+        expected_resolved = self.resolver.resolve(self.identifier)
+        # served from memory without looking at the source roots again
+        self.resolver.source_roots = []
+        self.assertEqual(self.resolver.resolve(self.identifier), expected_resolved)
+
+    def test_resolve_not_remembered_by_default(self):
+        self.resolver.resolve(self.identifier)
+        self.resolver.source_roots = []
+        with self.assertRaises(loris_exception.ResolverException):
+            self.resolver.resolve(self.identifier)
+
 
 class ExtensionNormalizingFSResolverTest(SimpleFSResolverTest):
     '''The ExtensionNormalizingFSResolver is deprecated - see note in loris/resolvers.py.'''
@@ -1,6 +1,12 @@
 from loris.resolver import SimpleHTTPResolver
 from loris.loris_exception import ResolverException
+from httplib import HTTPMessage
+from requests.cookies import extract_cookies_to_jar
+from StringIO import StringIO
+import errno
+import mock
 import os
+import requests
 import shutil
 import unittest
 import responses
@@ -67,6 +73,7 @@ class SimpleHTTPResolverTest(unittest.TestCase):
                 self.identifier_url,
                 body='II*\x00\x0c\x00\x00\x00\x80\x00  \x0e\x00\x00\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x01\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x02\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x03\x01\x03\x00\x01\x00\x00\x00\x05\x00\x00\x00\x06\x01\x03\x00\x01\x00\x00\x00\x03\x00\x00\x00\x11\x01\x04\x00\x01\x00\x00\x00\x08\x00\x00\x00\x15\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00\x16\x01\x03\x00\x01\x00\x00\x00\x08\x00\x00\x00\x17\x01\x04\x00\x01\x00\x00\x00\x04\x00\x00\x00\x1a\x01\x05\x00\x01\x00\x00\x00\xba\x00\x00\x00\x1b\x01\x05\x00\x01\x00\x00\x00\xc2\x00\x00\x00\x1c\x01\x03\x00\x01\x00\x00\x00\x01\x00\x00\x00(\x01\x03\x00\x01\x00\x00\x00\x02\x00\x00\x00@\x01\x03\x00\x00\x03\x00\x00\xca\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00H\x00\x00\x00\x01\x00\x00\x00\xff`\xe6q\x19\x08\x00\x00\x80\t\x00\x00\x80\n\x00\x00\x80\x0b\x00\x00\x80\x0c\x00\x00\x80\r',
                 status=200,
+                stream=True,
                 content_type='image/tiff'
         )
         responses.add(
@@ -116,6 +123,53 @@ class SimpleHTTPResolverTest(unittest.TestCase):
         self.assertTrue(os.path.isfile(self.expected_filepath))
         self.assertEqual(self.resolver.cached_file_for_ident(self.identifier), self.expected_filepath)
 
+    @responses.activate
+    def test_cached_file_for_ident_with_default_format(self):
+        self.resolver.default_format = 'tif'
+        self.assertEqual(self.resolver.cached_file_for_ident(self.identifier), None)
+        self.resolver.copy_to_cache(self.identifier)
+        self.assertEqual(self.resolver.cached_file_for_ident(self.identifier), self.expected_filepath)
+
+    @responses.activate
+    def test_copy_to_cache_when_already_cached(self):
+        self.resolver.copy_to_cache(self.identifier)
+        # a second download of the same image, e.g. by another process, keeps
+        # the existing file and leaves no temporary files behind
+        self.assertEqual(self.resolver.copy_to_cache(self.identifier), self.expected_filepath)
+        self.assertEqual(os.listdir(self.expected_filedir), ['loris_cache.tif'])
+
+    @responses.activate
+    def test_copy_to_cache_without_hard_links(self):
+        link_error = OSError(errno.EPERM, 'Operation not permitted')
+        with mock.patch('loris.resolver.link', side_effect=link_error):
+            local_fp = self.resolver.copy_to_cache(self.identifier)
+        self.assertEqual(local_fp, self.expected_filepath)
+        self.assertTrue(os.path.isfile(self.expected_filepath))
+        self.assertEqual(os.listdir(self.expected_filedir), ['loris_cache.tif'])
+
+    @responses.activate
+    def test_resolve_after_cached_file_removed(self):
+        self.resolver.resolve(self.identifier)
+        os.remove(self.expected_filepath)
+        resolved = self.resolver.resolve(self.identifier)
+        self.assertSequenceEqual(resolved, (self.expected_filepath, self.expected_format))
+        self.assertTrue(os.path.isfile(self.expected_filepath))
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_resolve_with_content_type_parameters(self):
+        responses.add(
+                responses.GET,
+                'http://sample.sample/0004',
+                body='II*\x00',
+                status=200,
+                stream=True,
+                content_type='Image/JPEG; charset=binary'
+        )
+        resolved_fp, resolved_format = self.resolver.resolve('0004')
+        self.assertEqual(resolved_format, 'jpg')
+        self.assertTrue(resolved_fp.endswith('loris_cache.jpg'))
+
     @responses.activate
     def test_resolve_001(self):
         expected_resolved = (self.expected_filepath, self.expected_format)
@@ -138,6 +192,48 @@ class SimpleHTTPResolverTest(unittest.TestCase):
                 self.resolver.is_resolvable(self.not_identifier)
         )
 
+    @responses.activate
+    def test_is_resolvable_remembers_source_response(self):
+        self.assertTrue(self.resolver.is_resolvable(self.identifier))
+        self.assertFalse(self.resolver.is_resolvable(self.not_identifier))
+        self.assertTrue(self.resolver.is_resolvable(self.identifier))
+        self.assertFalse(self.resolver.is_resolvable(self.not_identifier))
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_is_resolvable_without_head_cache(self):
+        self.resolver.head_cache_ttl = 0
+        self.assertTrue(self.resolver.is_resolvable(self.identifier))
+        self.assertTrue(self.resolver.is_resolvable(self.identifier))
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_cookies_not_kept(self):
+        # as if a response to an earlier request had set a session cookie
+        response = mock.Mock()
+        response._original_response.msg = HTTPMessage(
+                StringIO('Set-Cookie: JSESSIONID=abc123; Path=/\r\n\r\n')
+        )
+        request = requests.Request('GET', self.not_identifier_url).prepare()
+        extract_cookies_to_jar(self.resolver.session.cookies, request, response)
+        self.assertEqual(len(self.resolver.session.cookies), 0)
+
+        self.assertTrue(self.resolver.is_resolvable(self.identifier))
+        self.assertNotIn('Cookie', responses.calls[0].request.headers)
+
+    @responses.activate
+    def test_ident_regex(self):
+        self.resolver = SimpleHTTPResolver({
+            'cache_root': self.cache_dir,
+            'source_prefix': 'http://sample.sample/',
+            'head_resolvable': True,
+            'ident_regex': r'^\d+$'
+        })
+        self.assertTrue(self.resolver.is_resolvable(self.identifier))
+        # rejected by the regex before any request is made
+        self.assertFalse(self.resolver.is_resolvable('not-a-number'))
+        self.assertEqual(len(responses.calls), 1)
+
     def tearDown(self):
         # Clean Up the cache directory
         if os.path.exists(self.cache_dir):
@@ -188,6 +284,63 @@ class SimpleHTTPResolverConfigTest(unittest.TestCase):
         self.assertEqual(resolver.uri_resolvable, True)
         self.assertEqual(resolver.user, 'TestUser')
         self.assertEqual(resolver.pw, 'TestPW')
+        self.assertEqual(resolver.session.auth, ('TestUser', 'TestPW'))
+        self.assertEqual(resolver.session.verify, True)
+
+    def test_web_request_url_without_scheme(self):
+        config = {
+            'cache_root': self.cache_dir,
+            'uri_resolvable': True
+        }
+        resolver = SimpleHTTPResolver(config)
+        self.assertEqual(
+                resolver._web_request_url('https://sample.sample/0001')[0],
+                'https://sample.sample/0001'
+        )
+        self.assertRaises(
+                ResolverException,
+                lambda: resolver._web_request_url('sample.sample/0001')
+        )
+
+    def test_cache_hash_version(self):
+        config = {
+            'cache_root': self.cache_dir,
+            'uri_resolvable': True,
+            'cache_hash_version': '2'
+        }
+        resolver = SimpleHTTPResolver(config)
+        self.assertEqual(resolver.cache_hash_version, 2)
+        # 'a b' is quoted to 'a+b' before hashing under version 1
+        self.assertEqual(
+                resolver.cache_dir_path('a%20b'),
+                os.path.join(self.cache_dir, '0c', 'c9c', 'd4d', 'd26', 'c51', '37b', '675', 'a0d', '819', 'cb9', 'ab0')
+        )
+        self.assertNotEqual(
+                SimpleHTTPResolver._cache_subroot('a b', 1),
+                SimpleHTTPResolver._cache_subroot('a b', 2)
+        )
+
+        config['cache_hash_version'] = 3
+        self.assertRaises(
+                ResolverException,
+                lambda: SimpleHTTPResolver(config)
+        )
+
+    def test_cache_subroot(self):
+        ident_dirs = SimpleHTTPResolver._ident_file_structure
+        self.assertEqual(
+                SimpleHTTPResolver._cache_subroot('0001'),
+                ident_dirs('0001')
+        )
+        self.assertEqual(
+                SimpleHTTPResolver._cache_subroot('ns:sub:0001'),
+                os.path.join('ns', 'sub', ident_dirs('ns:sub:0001'))
+        )
+        for uri in ('http://sample.sample/0001', 'https:/sample.sample/0001'):
+            self.assertEqual(
+                    SimpleHTTPResolver._cache_subroot(uri),
+                    os.path.join('http', ident_dirs(uri))
+            )
 
     def test_barebones_config(self):
         config = {
@@ -32,6 +32,13 @@ class SourceImageCachingResolverTest(AbstractResolverTest, unittest.TestCase):
         # Make sure the file exists in the cache
         self.assertTrue(os.path.isfile(self.expected_filepath))
 
+    def test_resolve_two_images_in_one_directory(self):
+        self.resolver.resolve(self.identifier)
+        other_identifier = '01/02/gray.jp2'
+        resolved_fp, _ = self.resolver.resolve(other_identifier)
+        self.assertEqual(resolved_fp, os.path.join(self.cache_dir, other_identifier))
+        self.assertTrue(os.path.isfile(resolved_fp))
+
     def tearDown(self):
         # Clean Up the cache directory
         if os.path.exists(self.cache_dir):